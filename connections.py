@@ -0,0 +1,79 @@
+import asyncio
+import json
+import os
+from http import HTTPStatus
+
+# Connection settings for the websocket server. Dashboards hold connections
+# open for hours between questions, so an idle connection should cost as
+# little as possible: keepalive is done with protocol-level pings handled
+# inside websockets, compression is off (each deflate context costs tens of KB
+# per connection), and connections are reaped when no prompt has arrived for
+# WS_IDLE_TIMEOUT_SECONDS.
+PING_INTERVAL_SECONDS = float(os.getenv("WS_PING_INTERVAL_SECONDS", "30"))
+PING_TIMEOUT_SECONDS = float(os.getenv("WS_PING_TIMEOUT_SECONDS", "30"))
+IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", str(4 * 60 * 60)))
+MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS", "20000"))
+MAX_MESSAGE_BYTES = int(os.getenv("WS_MAX_MESSAGE_BYTES", str(64 * 1024)))
+
+SERVE_OPTIONS = {
+    "ping_interval": PING_INTERVAL_SECONDS,
+    "ping_timeout": PING_TIMEOUT_SECONDS,
+    "max_size": MAX_MESSAGE_BYTES,
+    "max_queue": 4,
+    "compression": None
+}
+
+
+class ConnectionLimiter:
+    """
+    Counts connections from the moment their handshake is accepted until they
+    close, and turns new ones away at the handshake once full.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self.active = 0
+
+    def process_request(self, connection, request):
+        if self.active >= self.max_connections:
+            print(f"Rejecting connection - {self.active} connections open", flush=True)
+            return connection.respond(HTTPStatus.SERVICE_UNAVAILABLE, "Server at capacity\n")
+        # Counted here rather than in the handler so handshakes that are
+        # still in flight count against the limit too. A callback on the
+        # connection's close future is cheaper than a task per connection.
+        self.active += 1
+        connection.connection_lost_waiter.add_done_callback(self._release)
+        return None
+
+    def _release(self, _):
+        self.active -= 1
+
+
+async def receive_message(websocket):
+    """
+    Waits for the next message that isn't an application-level ping and
+    parses it. Closes the connection if nothing else arrives within
+    IDLE_TIMEOUT_SECONDS; pings don't count as activity.
+
+    Args:
+        websocket: The WebSocket connection object.
+
+    Returns:
+        dict | None: The parsed message, or None if the connection was reaped.
+
+    Raises:
+        ValueError: If the message isn't a JSON object.
+    """
+    deadline = asyncio.get_running_loop().time() + IDLE_TIMEOUT_SECONDS
+    try:
+        async with asyncio.timeout_at(deadline):
+            while True:
+                message_data = json.loads(await websocket.recv())
+                if not isinstance(message_data, dict):
+                    raise ValueError("Message is not a JSON object")
+                # Application pings from older clients are dropped without logging
+                if message_data.get('role') != 'ping':
+                    return message_data
+    except TimeoutError:
+        await websocket.close(1001, "Idle timeout")
+        return None
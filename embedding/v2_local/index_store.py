@@ -0,0 +1,118 @@
+import asyncio
+import os
+import pickle
+import time
+from contextlib import contextmanager
+
+import faiss
+
+# Polling is cheap (two stat calls) and avoids a file-watching dependency
+WATCH_INTERVAL_SECONDS = float(os.getenv("INDEX_WATCH_INTERVAL_SECONDS", "5"))
+
+
+class IndexVersion:
+    """One loaded FAISS index with the chunks it was built from."""
+
+    def __init__(self, version, index, chunks, mtimes):
+        self.version = version
+        self.index = index
+        self.chunks = chunks
+        self.mtimes = mtimes
+        self.loaded_at = time.time()
+        self.active_searches = 0
+        self.retired = False
+
+    def release_if_drained(self):
+        if self.retired and self.active_searches == 0 and self.index is not None:
+            self.index = None
+            self.chunks = None
+            print(f"Released embedding index version {self.version}", flush=True)
+
+
+class IndexStore:
+    """
+    Holds the current embedding index and swaps in rebuilt ones without a
+    restart. A new version is loaded alongside the old one and swapped in
+    atomically; searches already running on the old version finish on it
+    before its memory is released.
+    """
+
+    def __init__(self, index_path, chunks_path):
+        self.index_path = index_path
+        self.chunks_path = chunks_path
+        self.current = self._load(1)
+
+    def _mtimes(self):
+        return (os.path.getmtime(self.index_path), os.path.getmtime(self.chunks_path))
+
+    def _load(self, version):
+        mtimes = self._mtimes()
+        index = faiss.read_index(self.index_path)
+        with open(self.chunks_path, 'rb') as f:
+            chunks = pickle.load(f)
+        if index.ntotal != len(chunks):
+            raise ValueError(f"Index has {index.ntotal} vectors but there are {len(chunks)} chunks")
+        return IndexVersion(version, index, chunks, mtimes)
+
+    @contextmanager
+    def acquire(self):
+        """
+        Pins the current version for the duration of a search.
+
+        Yields:
+            IndexVersion: The version to search, valid until the block exits.
+        """
+        version = self.current
+        version.active_searches += 1
+        try:
+            yield version
+        finally:
+            version.active_searches -= 1
+            version.release_if_drained()
+
+    async def reload(self):
+        """
+        Loads the index files from disk in a worker thread and swaps them in.
+
+        Returns:
+            int: The version now being served.
+        """
+        loop = asyncio.get_running_loop()
+        new_version = await loop.run_in_executor(None, self._load, self.current.version + 1)
+        old_version = self.current
+        self.current = new_version
+        old_version.retired = True
+        old_version.release_if_drained()
+        print(f"Swapped embedding index version {old_version.version} -> {new_version.version} "
+              f"({new_version.index.ntotal} vectors)", flush=True)
+        return new_version.version
+
+    async def watch(self, interval=WATCH_INTERVAL_SECONDS):
+        """
+        Reloads once both index files have been rewritten and have stopped
+        changing. preprocess_v2.py writes the index before the chunks, so a
+        new index is never paired with the chunks it replaced.
+        """
+        pending = None
+        failed = None
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                mtimes = self._mtimes()
+            except OSError:
+                continue
+            if not all(new > old for new, old in zip(mtimes, self.current.mtimes)):
+                pending = None
+            elif mtimes == failed:
+                # A bad rebuild is only retried once the files change again
+                continue
+            elif mtimes != pending:
+                # Wait one more interval so a half-written rebuild isn't picked up
+                pending = mtimes
+            else:
+                try:
+                    await self.reload()
+                except Exception as e:
+                    print(f"Failed to reload embedding index, waiting for the files to change: {str(e)}", flush=True)
+                    failed = mtimes
+                pending = None
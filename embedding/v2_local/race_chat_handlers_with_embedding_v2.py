@@ -2,10 +2,10 @@ import asyncio
 import json
 from google import genai
 import os
-import faiss
 import numpy as np
-import pickle
+from concurrent.futures import ThreadPoolExecutor
 from sentence_transformers import SentenceTransformer
+from embedding.v2_local.index_store import IndexStore
 
 # Add in below before startting server
 #  --------------------------------------------------------------------------  #
@@ -14,12 +14,21 @@ from sentence_transformers import SentenceTransformer
 # import pickle
 
 model = SentenceTransformer('all-MiniLM-L6-v2')
-index = faiss.read_index('embedding/v2_local/outputs/faiss_index.bin')
-with open('embedding/v2_local/outputs/chunks.pkl', 'rb') as f:
-    chunks = pickle.load(f)
+# Rebuilt index files are picked up by index_store.watch() without a restart
+index_store = IndexStore(
+    'embedding/v2_local/outputs/faiss_index.bin',
+    'embedding/v2_local/outputs/chunks.pkl'
+)
 
 client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
+# Encoding and index search are CPU bound, so they get their own bounded pool
+# instead of competing with everything else on the loop's default executor
+embedding_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("EMBEDDING_WORKERS", "4")),
+    thread_name_prefix="embedding"
+)
+
 async def race_stream_response(prompt, queue, loop):
     """
     Generates a streaming response for a race chat prompt using context from a large file.
@@ -30,16 +39,17 @@ async def race_stream_response(prompt, queue, loop):
         loop (asyncio.AbstractEventLoop): The event loop for running synchronous tasks.
     """
     try:
-        prompt_embedding = await loop.run_in_executor(None, lambda: model.encode(prompt))
+        prompt_embedding = await loop.run_in_executor(embedding_executor, lambda: model.encode(prompt))
         
         # Search for top-k similar chunks
         k = 10 
-        distances, indices = await loop.run_in_executor(
-            None,
-            lambda: index.search(np.array([prompt_embedding]).astype('float32'), k)
-        )
-        
-        relevant_chunks = [chunks[i] for i in indices[0] if i < len(chunks)]
+        with index_store.acquire() as index_version:
+            distances, indices = await loop.run_in_executor(
+                embedding_executor,
+                lambda: index_version.index.search(np.array([prompt_embedding]).astype('float32'), k)
+            )
+            chunks = index_version.chunks
+            relevant_chunks = [chunks[i] for i in indices[0] if i < len(chunks)]
         context = " ".join(relevant_chunks) if relevant_chunks else "No context available."
         
         # print('---------------------------', flush=True)
@@ -57,14 +67,16 @@ async def race_stream_response(prompt, queue, loop):
                 "role": "assistant",
                 "response": chunk.text,
                 "isDone": False,
-                "timestamp": None
+                "timestamp": None,
+                "indexVersion": index_version.version
             }
             await queue.put(json.dumps(message))
         await queue.put(json.dumps({
             "role": "assistant",
             "response": "done message",
             "isDone": True,
-            "timestamp": None
+            "timestamp": None,
+            "indexVersion": index_version.version
         }))
         print("Race chat stream completed")
     except Exception as e:
@@ -104,7 +116,8 @@ async def handle_race_client(websocket):
                 continue
 
             queue = asyncio.Queue()
-            asyncio.create_task(race_stream_response(prompt, queue, loop))
+            # Held so the task can't be garbage collected while it streams
+            response_task = asyncio.create_task(race_stream_response(prompt, queue, loop))
             
             while True:
                 chunk = await queue.get()
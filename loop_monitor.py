@@ -0,0 +1,84 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+# Opt-in event loop stall detector. Set LOOP_STALL_THRESHOLD_MS to turn it on,
+# e.g. LOOP_STALL_THRESHOLD_MS=100 python streamer.py
+#
+# A heartbeat coroutine stamps the time on every loop iteration it gets. A
+# watchdog thread checks the stamp, and when the loop hasn't come back within
+# the threshold it samples the loop thread's stack, which points at the
+# callback that is blocking every other connection.
+
+HEARTBEAT_INTERVAL_SECONDS = 0.01
+MAX_RECORDED_STALLS = 100
+
+
+class LoopStallMonitor:
+    def __init__(self, threshold_ms):
+        self.threshold = threshold_ms / 1000
+        self.stalls = deque(maxlen=MAX_RECORDED_STALLS)
+        self._last_beat = time.monotonic()
+        self._loop_thread_id = None
+        self._stopped = threading.Event()
+        self._heartbeat_task = None
+
+    def start(self):
+        """Starts the heartbeat on the running loop and the watchdog thread."""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-stall-monitor", daemon=True).start()
+        print(f"Event loop stall monitor started (threshold {self.threshold * 1000:.0f}ms)", flush=True)
+
+    def stop(self):
+        self._stopped.set()
+
+    async def _heartbeat(self):
+        while not self._stopped.is_set():
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+
+    def _watch(self):
+        stalled_beat = None
+        stall = None
+        while not self._stopped.wait(self.threshold / 2):
+            beat = self._last_beat
+            if stall is not None:
+                if beat == stalled_beat:
+                    continue
+                # The heartbeat is back: the stall lasted from the last beat
+                # before it to the first one after it
+                stall["lag_ms"] = (beat - stalled_beat - HEARTBEAT_INTERVAL_SECONDS) * 1000
+                print(f"Event loop stalled for {stall['lag_ms']:.0f}ms in:\n{stall['stack']}", flush=True)
+                stall = None
+            lag = time.monotonic() - beat - HEARTBEAT_INTERVAL_SECONDS
+            if lag < self.threshold:
+                continue
+            # Sample the stack while the loop is still blocked; the duration
+            # is filled in once it comes back
+            stalled_beat = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<no stack available>"
+            stall = {"lag_ms": lag * 1000, "timestamp": time.time(), "stack": stack}
+            self.stalls.append(stall)
+
+
+def start_loop_monitor():
+    """
+    Starts the stall monitor if LOOP_STALL_THRESHOLD_MS is set. Must be called
+    from inside the running event loop.
+
+    Returns:
+        LoopStallMonitor | None: The running monitor, or None when disabled.
+    """
+    threshold_ms = os.getenv("LOOP_STALL_THRESHOLD_MS")
+    if not threshold_ms:
+        return None
+    monitor = LoopStallMonitor(float(threshold_ms))
+    monitor.start()
+    return monitor
@@ -2,6 +2,11 @@ import asyncio
 import json
 from google import genai
 import os
+from stream_replay import replay_buffer, resume_stream
+from connections import receive_message
+from race_data_compact import (
+    COMPACT_SCHEMA, COMPACT_DIR, VERBOSE_DIR, read_source_version, source_version, write_compact_file
+)
 
 client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
 
@@ -11,30 +16,22 @@ MODEL_MAPPINGS = {
     '2.0 Flash': 'gemini-2.0-flash'
 }
 
-# Message format from user
-# MessageFromUser {
-#   role: 'user' | 'ping';
-#   prompt: string;
-#   race: string;
-#   timestamp: number;
-#}
+# 'compact' serves the per-driver lap tables built by race_data_compact.py,
+# 'verbose' the original labelled per-lap layout
+RACE_DATA_FORMAT = os.getenv("RACE_DATA_FORMAT", "compact")
+if RACE_DATA_FORMAT not in ("compact", "verbose"):
+    raise ValueError(f"Unknown RACE_DATA_FORMAT: {RACE_DATA_FORMAT}")
 
-# MessageFromAsssistant { 
-#   role: 'assistant' | 'error'; 
-#   response: string; 
-#   isDone: boolean; 
-#   timestamp: Date; 
-# }
+RACE_DATA_DIRS = {
+    'compact': COMPACT_DIR,
+    'verbose': VERBOSE_DIR
+}
 
-async def race_stream_response(prompt, race_name, queue, model_name='gemini-2.0-flash'):
-    try:
-        print(f"Processing race chat prompt for {race_name}: {prompt}", flush=True)
-        
-        file_path = f"./race-data/less_data/race_data_{race_name}_2024_Race.txt"
-        
-        file = client.files.upload(file=file_path)
+RACE_DATA_INTRO = "You are a racing expert. The uploaded file provides race overview stats at the top, and then all 20 drivers stats by lap. "
 
-        prompt = """You are a racing expert. The uploaded file provides race overview stats at the top, and then all 20 drivers stats by lap. The beginning of each drivers stats is like this
+RACE_DATA_SCHEMAS = {
+    'compact': COMPACT_SCHEMA,
+    'verbose': """The beginning of each drivers stats is like this
         DRIVER: Driver name (#driver number)
         Team: Team name
         --------------------------------------------------
@@ -62,7 +59,95 @@ async def race_stream_response(prompt, race_name, queue, model_name='gemini-2.0-
           Brake Usage Stats:
             - Time on Brakes: percent of lap spent on brakes
             - Brake Applications: number of brake applications from race samples
-            - Distinct Brake Zones: number of distinct brake zones
+            - Distinct Brake Zones: number of distinct brake zones"""
+}
+
+# Message format from user
+# MessageFromUser {
+#   role: 'user' | 'ping' | 'resume';   // 'ping' is no longer needed, the server sends protocol pings
+#   prompt: string;
+#   race: string;
+#   timestamp: number;
+#}
+
+# MessageFromAsssistant { 
+#   role: 'assistant' | 'error'; 
+#   response: string; 
+#   isDone: boolean; 
+#   timestamp: Date; 
+#   streamId: string;
+#   seq: number;
+#   raceDataVersion: string;   // content hash of the race data file answered from
+# }
+# See stream_replay.py for the resume message
+
+# Regenerating a compact file is rare, but two requests for the same stale
+# race shouldn't convert it at the same time
+_conversion_lock = asyncio.Lock()
+# path -> (mtime, size, source version), so unchanged files aren't rehashed
+_source_versions = {}
+
+async def race_data_file(race_name):
+    """
+    Picks the file to upload for a race. Files are looked up on every request,
+    so new or regenerated race files are served without a restart. In compact
+    mode a compact file built from a different version of its verbose source
+    is regenerated first; if that fails the verbose file is served instead. A
+    race that only has a compact file is served as is.
+
+    Returns:
+        tuple: (file path, format of that file, race data version). The
+        version is a content hash of the verbose source file.
+    """
+    file_name = f"race_data_{race_name}_2024_Race.txt"
+    verbose_path = f"{RACE_DATA_DIRS['verbose']}/{file_name}"
+    compact_path = f"{RACE_DATA_DIRS['compact']}/{file_name}"
+    version = _verbose_source_version(verbose_path)
+    if RACE_DATA_FORMAT == 'verbose':
+        return verbose_path, 'verbose', version
+
+    if version is None:
+        return compact_path, 'compact', read_source_version(compact_path)
+    if read_source_version(compact_path) != version:
+        async with _conversion_lock:
+            if read_source_version(compact_path) != version:
+                print(f"Regenerating compact race data for {race_name}", flush=True)
+                loop = asyncio.get_running_loop()
+                try:
+                    _, _, version = await loop.run_in_executor(None, write_compact_file, verbose_path)
+                except Exception as e:
+                    print(f"Failed to regenerate compact race data for {race_name}, "
+                          f"serving the verbose file: {str(e)}", flush=True)
+                    return verbose_path, 'verbose', version
+    return compact_path, 'compact', version
+
+def _verbose_source_version(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    cached = _source_versions.get(path)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    with open(path, 'rb') as f:
+        version = source_version(f.read())
+    _source_versions[path] = (stat.st_mtime, stat.st_size, version)
+    return version
+
+def normalize_prompt(prompt):
+    """Folds case, whitespace and trailing punctuation so near-identical questions coalesce."""
+    return " ".join((prompt or "").lower().split()).rstrip("?!. ")
+
+async def race_stream_response(prompt, race_name, stream, model_name='gemini-2.0-flash'):
+    file = None
+    try:
+        print(f"Processing race chat prompt for {race_name}: {prompt}", flush=True)
+        
+        file_path, data_format, data_version = await race_data_file(race_name)
+        
+        file = await client.aio.files.upload(file=file_path)
+
+        prompt = RACE_DATA_INTRO + RACE_DATA_SCHEMAS[data_format] + """
         Use that to help you find driver specific data. In your answer back don't mention from the provided data, just answer the question. 
         Also if you're giving data back to the user, display in a nice, easy to read, way that also looks good. Feel free to use markup when needed. Prompt: """ + prompt
         
@@ -74,22 +159,29 @@ async def race_stream_response(prompt, race_name, queue, model_name='gemini-2.0-
                 "role": "assistant",
                 "response": chunk.text,
                 "isDone": False,
-                "timestamp": None
+                "timestamp": None,
+                "raceDataVersion": data_version
             }
-            await queue.put(json.dumps(message))
+            await stream.put(message)
             
-        # Cleanup: Delete the uploaded file
-        client.files.delete(name=file.name)
-        await queue.put(json.dumps({
+        await stream.put({
             "role": "assistant",
             "response": "done message",
             "isDone": True,
-            "timestamp": None
-        }))
-        await queue.put(None)
+            "timestamp": None,
+            "raceDataVersion": data_version
+        })
         print("Race chat stream completed", flush=True)
     except Exception as e:
-        await _send_error_message(queue, "Error getting race data from LLM")
+        await _send_error_message(stream, "Error getting race data from LLM")
+    finally:
+        # Cleanup: Delete the uploaded file, including when the stream was cancelled
+        if file is not None:
+            try:
+                await client.aio.files.delete(name=file.name)
+            except Exception as e:
+                print(f"Failed to delete uploaded race file {file.name}: {str(e)}", flush=True)
+        await stream.close()
 
 async def handle_race_client(websocket):
     client_id = id(websocket)
@@ -97,12 +189,18 @@ async def handle_race_client(websocket):
     
     try:
         while True:
-            raw_message = await websocket.recv()
             try:
-                message_data = json.loads(raw_message)
-                
-                if message_data.get('role') == 'ping':
-                    print("Received ping from race chat client - continuing", flush=True)
+                message_data = await receive_message(websocket)
+            except ValueError as e:
+                print(f"Invalid message received from race chat client {client_id}: {str(e)}", flush=True)
+                await _send_error(websocket, "Invalid message format received from client")
+                continue
+            if message_data is None:
+                print(f"Closed idle race chat client {client_id}", flush=True)
+                break
+            try:
+                if message_data.get('role') == 'resume':
+                    await resume_stream(websocket, message_data)
                     continue
                 
                 prompt = message_data.get('prompt')
@@ -115,31 +213,37 @@ async def handle_race_client(websocket):
                 print(f"Received race chat prompt from client {client_id} for race {race_name}: {prompt}", flush=True)
             except Exception as e:
                 print(f"Invalid message received from race chat client {client_id}: {str(e)}", flush=True)
-                await _send_error_message(queue, "Invalid message format received from client")
+                await _send_error(websocket, "Invalid message format received from client")
                 continue
 
-            queue = asyncio.Queue()
             gemini_model_name = MODEL_MAPPINGS.get(model_name, 'gemini-2.0-flash')
-            asyncio.create_task(race_stream_response(prompt, race_name, queue, gemini_model_name))
-            
-            while True:
-                chunk = await queue.get()
-                if chunk is None:
-                    break
-                await websocket.send(chunk)
+            # Identical questions about the same race share one upstream call
+            key = (gemini_model_name, race_name, normalize_prompt(prompt))
+            stream, created = replay_buffer.join(key)
+            if created:
+                stream.task = asyncio.create_task(race_stream_response(prompt, race_name, stream, gemini_model_name))
+            else:
+                print(f"Client {client_id} joined in-flight stream {stream.stream_id}", flush=True)
+            await stream.send_to(websocket)
     
-    except json.JSONDecodeError as e:
-        print(f"Invalid JSON received from race chat client {client_id}: {str(e)}", flush=True)
-        await _send_error_message(queue, "Invalid JSON received")
     except Exception as e:
         print(f"Unexpected error in race chat handler for client {client_id}: {str(e)}", flush=True)
         await websocket.close(code=1011, reason=str(e))
 
-async def _send_error_message(queue, error_message):
+async def _send_error_message(stream, error_message):
     error_message = {
         "role": "error",
         "response": error_message,
         "isDone": True,
         "timestamp": None
     }
-    await queue.put(json.dumps(error_message))
+    await stream.put(error_message)
+
+async def _send_error(websocket, error_message):
+    # Errors outside of a stream have no stream ID or sequence number to resume from
+    await websocket.send(json.dumps({
+        "role": "error",
+        "response": error_message,
+        "isDone": True,
+        "timestamp": None
+    }))
@@ -0,0 +1,257 @@
+import argparse
+import hashlib
+import os
+import re
+
+# Converts the verbose race files in race-data/less_data into compact per-driver
+# tables in race-data/compact. The verbose layout repeats ~25 labelled lines for
+# every lap; the compact one is a single CSV row per lap, grouped into stints by
+# tyre compound, with the column meanings explained once in the prompt instead
+# (see COMPACT_SCHEMA below and race_chat_handlers_less_data.py).
+#
+# Usage:
+#   python race_data_compact.py                 # convert and compare sizes
+#   python race_data_compact.py --count-tokens  # also count tokens with Gemini
+#
+# Each compact file starts with a "Source version:" line holding a hash of the
+# verbose file it was built from, so the server can tell when it is stale
+# without relying on file modification times.
+
+VERBOSE_DIR = "./race-data/less_data"
+COMPACT_DIR = "./race-data/compact"
+SOURCE_VERSION_PREFIX = "Source version: "
+
+COLUMNS = [
+    "lap", "time", "s1", "s2", "s3", "trap1", "trap2", "trap3", "pb",
+    "vmax", "vavg", "thr_full", "thr_part", "thr_none", "thr_avg",
+    "brake_pct", "brake_apps", "samples", "brake_zones"
+]
+
+COMPACT_SCHEMA = """Each driver section starts with a line like
+        DRIVER: Driver name (#driver number) | Team: Team name | Fastest: Lap N m:ss.sss | Avg: m:ss.sss
+        followed by a header row of column names and then one comma separated row per lap. Laps are grouped into stints,
+        each introduced by a line like "Stint 2: HARD" whenever the tire compound changes. Columns:
+          lap: lap number
+          time: lap time (m:ss.sss)
+          s1, s2, s3: sector 1, 2 and 3 times in seconds
+          trap1, trap2, trap3: speed trap 1, 2 and 3 speeds in km/h
+          pb: Y if this was the driver's personal best lap so far, N otherwise
+          vmax, vavg: max and average speed of the lap in km/h
+          thr_full: percentage of lap at full throttle (>=95%)
+          thr_part: percentage of lap at partial throttle (5-95%)
+          thr_none: percentage of lap with no throttle (<=5%)
+          thr_avg: average throttle of the lap in percent
+          brake_pct: percentage of lap spent on the brakes
+          brake_apps: number of brake applications out of the lap's telemetry samples
+          samples: number of telemetry samples in the lap
+          brake_zones: number of distinct brake zones
+        An empty value means no data was recorded for that lap."""
+
+LAP_FIELDS = [
+    (re.compile(r"^Time: (.+)$"), ("time",)),
+    (re.compile(r"^S([123]): (.+)$"), None),
+    (re.compile(r"^Trap ([123]): (.+)$"), None),
+    (re.compile(r"^Tire Compound: (.+)$"), ("compound",)),
+    (re.compile(r"^Personal Best: (.+)$"), ("pb",)),
+    (re.compile(r"^Max Speed: ([\d.]+) km/h$"), ("vmax",)),
+    (re.compile(r"^Avg Speed: ([\d.]+) km/h$"), ("vavg",)),
+    (re.compile(r"^- Full Throttle \(.*\): ([\d.]+)% of lap$"), ("thr_full",)),
+    (re.compile(r"^- Partial Throttle \(.*\): ([\d.]+)% of lap$"), ("thr_part",)),
+    (re.compile(r"^- No Throttle \(.*\): ([\d.]+)% of lap$"), ("thr_none",)),
+    (re.compile(r"^- Average Throttle: ([\d.]+)%$"), ("thr_avg",)),
+    (re.compile(r"^- Time on Brakes: ([\d.]+)% of lap$"), ("brake_pct",)),
+    (re.compile(r"^- Brake Applications: (\d+) out of (\d+) samples$"), ("brake_apps", "samples")),
+    (re.compile(r"^- Distinct Brake Zones: (\d+)$"), ("brake_zones",)),
+]
+
+
+def _clean(value):
+    """Drops the placeholders and redundant units that cost tokens but carry no data."""
+    value = value.strip()
+    if value in ("No time", "nan", "NaT"):
+        return ""
+    if value.endswith(".0") and value[:-2].isdigit():
+        return value[:-2]
+    if value.startswith("0:"):
+        return value[2:]
+    return value
+
+
+def _parse_lap_line(line, lap):
+    for pattern, keys in LAP_FIELDS:
+        match = pattern.match(line)
+        if not match:
+            continue
+        if keys is None:
+            # Sector and trap lines carry their number in the first group
+            prefix = "s" if line.startswith("S") else "trap"
+            lap[f"{prefix}{match.group(1)}"] = _clean(match.group(2))
+        else:
+            for key, value in zip(keys, match.groups()):
+                lap[key] = _clean(value)
+        return
+
+
+def _format_driver(driver_line, team, summary, laps):
+    header = f"{driver_line} | Team: {team}"
+    if summary.get("fastest"):
+        header += f" | Fastest: {summary['fastest']}"
+    if summary.get("average"):
+        header += f" | Avg: {summary['average']}"
+    lines = [header, ",".join(COLUMNS)]
+    stint = 0
+    compound = None
+    for lap in laps:
+        if lap.get("compound") != compound:
+            compound = lap.get("compound")
+            stint += 1
+            lines.append(f"Stint {stint}: {compound or 'UNKNOWN'}")
+        lap["pb"] = {"Yes": "Y", "No": "N"}.get(lap.get("pb"), "")
+        lines.append(",".join(lap.get(column, "") for column in COLUMNS))
+    return "\n".join(lines)
+
+
+def convert_race_text(text):
+    """
+    Converts the text of a verbose race file into the compact layout. The race
+    overview at the top and the session overview at the bottom are kept as is.
+
+    Args:
+        text (str): Contents of a race_data_*_Race.txt file.
+
+    Returns:
+        str: The compact rendering of the race.
+    """
+    output = []
+    driver = None
+    lap = None
+    in_laps = False
+
+    def flush_driver():
+        if driver is not None:
+            output.append(_format_driver(driver["line"], driver["team"], driver["summary"], driver["laps"]))
+            output.append("")
+
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if line.startswith("DRIVER:"):
+            flush_driver()
+            in_laps = True
+            driver = {"line": line, "team": "", "summary": {}, "laps": []}
+            lap = None
+            continue
+        if line == "SESSION OVERVIEW FOR LLM ANALYSIS":
+            flush_driver()
+            driver = None
+            in_laps = False
+        if not in_laps:
+            output.append(raw_line)
+            continue
+
+        lap_match = re.match(r"^Lap (\d+):$", line)
+        if lap_match:
+            lap = {"lap": lap_match.group(1)}
+            driver["laps"].append(lap)
+        elif lap is not None:
+            _parse_lap_line(line, lap)
+        elif line.startswith("Team: "):
+            driver["team"] = line[len("Team: "):]
+        elif line.startswith("Fastest Lap: "):
+            fastest = line[len("Fastest Lap: "):].replace(".0 - ", " ").replace(" - ", " ")
+            driver["summary"]["fastest"] = "" if "nan" in fastest else fastest
+        elif line.startswith("Average Lap Time: "):
+            driver["summary"]["average"] = _clean(line[len("Average Lap Time: "):])
+
+    flush_driver()
+    # Separator lines are only decoration
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(output)).strip() + "\n"
+
+
+def compact_path(verbose_path):
+    return os.path.join(COMPACT_DIR, os.path.basename(verbose_path))
+
+
+def source_version(data):
+    """
+    Short content hash of a verbose race file.
+
+    Args:
+        data (bytes): Contents of a race_data_*_Race.txt file.
+    """
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def read_source_version(path):
+    """Returns the source version recorded at the top of a compact file, or None."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            first_line = f.readline().strip()
+    except OSError:
+        return None
+    if first_line.startswith(SOURCE_VERSION_PREFIX):
+        return first_line[len(SOURCE_VERSION_PREFIX):]
+    return None
+
+
+def write_compact_file(verbose_path):
+    """
+    Converts a verbose race file and writes the result next to the other
+    compact files, headed by the source version. The file is replaced
+    atomically, so a server reading it at the same time sees either the old
+    or the new version.
+
+    Args:
+        verbose_path (str): Path to a race_data_*_Race.txt file.
+
+    Returns:
+        tuple: (verbose text, compact text, source version)
+    """
+    with open(verbose_path, "rb") as f:
+        data = f.read()
+    version = source_version(data)
+    verbose = data.decode("utf-8")
+    compact = convert_race_text(verbose)
+    os.makedirs(COMPACT_DIR, exist_ok=True)
+    target = compact_path(verbose_path)
+    temp_path = f"{target}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(f"{SOURCE_VERSION_PREFIX}{version}\n{compact}")
+    os.replace(temp_path, target)
+    return verbose, compact, version
+
+
+def estimate_tokens(text):
+    """Rough offline token estimate: words, numbers and punctuation each count as one token."""
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def count_tokens(text):
+    """Counts tokens with the Gemini tokenizer. Needs GEMINI_API_KEY."""
+    from google import genai
+    client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    return client.models.count_tokens(model="gemini-2.0-flash", contents=text).total_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert race data files into compact per-driver tables")
+    parser.add_argument("--count-tokens", action="store_true", help="count tokens with the Gemini API")
+    args = parser.parse_args()
+
+    counter = count_tokens if args.count_tokens else estimate_tokens
+    label = "tokens" if args.count_tokens else "est. tokens"
+
+    print(f"{'race file':45} {'verbose KB':>10} {'compact KB':>10} {'verbose ' + label:>20} {'compact ' + label:>20} {'saved':>7}")
+    for name in sorted(os.listdir(VERBOSE_DIR)):
+        if not name.endswith(".txt"):
+            continue
+        verbose, compact, _ = write_compact_file(os.path.join(VERBOSE_DIR, name))
+
+        verbose_tokens = counter(verbose)
+        compact_tokens = counter(compact)
+        saved = 1 - compact_tokens / verbose_tokens
+        print(f"{name:45} {len(verbose.encode()) / 1024:10.0f} {len(compact.encode()) / 1024:10.0f} "
+              f"{verbose_tokens:20,} {compact_tokens:20,} {saved:7.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import asyncio
+import json
+import uuid
+from collections import OrderedDict
+
+# Every message sent back to a client is tagged with the stream it belongs to
+# and its position in that stream, so a client that drops mid-answer can
+# reconnect and ask for whatever it missed instead of re-asking the question.
+#
+# MessageFromAsssistant {
+#   role: 'assistant' | 'error';
+#   response: string;
+#   isDone: boolean;
+#   timestamp: Date;
+#   streamId: string;
+#   seq: number;
+# }
+#
+# ResumeFromUser {
+#   role: 'resume';
+#   streamId: string;
+#   lastSeq: number;   // last seq the client received, -1 for none
+# }
+
+MAX_BUFFERED_STREAMS = 256
+# How long a stream keeps generating with nobody listening, so a client that
+# dropped has a chance to resume before the upstream call is cancelled
+CANCEL_GRACE_SECONDS = 15
+
+
+class ReplayStream:
+    """
+    A single streamed response. Keeps every serialized chunk so it can be
+    replayed to a reconnecting client, then followed live until it finishes.
+    """
+
+    def __init__(self, stream_id, on_close=None):
+        self.stream_id = stream_id
+        self.chunks = []
+        self.done = False
+        self.task = None
+        self.subscribers = 0
+        self._on_close = on_close
+        self._cancel_task = None
+        self._changed = asyncio.Condition()
+
+    async def put(self, message):
+        """
+        Tags a message with this stream's ID and the next sequence number and
+        stores it.
+
+        Args:
+            message (dict): The message to send to the client.
+        """
+        if self.done:
+            return
+        message["streamId"] = self.stream_id
+        message["seq"] = len(self.chunks)
+        self.chunks.append(json.dumps(message))
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def close(self):
+        """Marks the stream finished so followers stop waiting for chunks."""
+        if self.done:
+            return
+        self.done = True
+        if self._on_close:
+            self._on_close(self)
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def send_to(self, websocket, last_seq=-1):
+        """
+        Sends every chunk after last_seq to the websocket, then keeps sending
+        new chunks as they arrive until the stream is done.
+
+        Args:
+            websocket: The WebSocket connection object.
+            last_seq (int): The last sequence number the client already has.
+        """
+        self._subscribe()
+        try:
+            next_seq = last_seq + 1
+            while True:
+                while next_seq < len(self.chunks):
+                    await websocket.send(self.chunks[next_seq])
+                    next_seq += 1
+                if self.done:
+                    return
+                async with self._changed:
+                    await self._changed.wait_for(
+                        lambda: self.done or next_seq < len(self.chunks)
+                    )
+        finally:
+            self._unsubscribe()
+
+    def _subscribe(self):
+        self.subscribers += 1
+        if self._cancel_task:
+            self._cancel_task.cancel()
+            self._cancel_task = None
+
+    def _unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done and self.task:
+            self._cancel_task = asyncio.create_task(self._cancel_upstream())
+
+    async def _cancel_upstream(self):
+        await asyncio.sleep(CANCEL_GRACE_SECONDS)
+        if self.subscribers or self.done:
+            return
+        print(f"No subscribers left on stream {self.stream_id} - cancelling upstream", flush=True)
+        self.task.cancel()
+        await self.put({
+            "role": "error",
+            "response": "Stream cancelled",
+            "isDone": True,
+            "timestamp": None
+        })
+        await self.close()
+
+
+class ReplayBuffer:
+    """
+    Bounded ring of recent streams, keyed by stream ID. When full, the oldest
+    finished stream is dropped first, falling back to the oldest stream.
+    """
+
+    def __init__(self, max_streams=MAX_BUFFERED_STREAMS):
+        self.max_streams = max_streams
+        self._streams = OrderedDict()
+        self._inflight = {}
+
+    def create(self, on_close=None):
+        stream = ReplayStream(uuid.uuid4().hex, on_close)
+        self._streams[stream.stream_id] = stream
+        while len(self._streams) > self.max_streams:
+            self._evict()
+        return stream
+
+    def join(self, key):
+        """
+        Single-flight lookup for identical requests. Returns the in-flight
+        stream for key if there is one, otherwise creates it.
+
+        Args:
+            key (tuple): Identifies requests that produce the same response.
+
+        Returns:
+            tuple: (stream, created). Only the caller that gets created=True
+            should start the upstream call.
+        """
+        stream = self._inflight.get(key)
+        if stream is not None and not stream.done:
+            return stream, False
+
+        def release(closed):
+            if self._inflight.get(key) is closed:
+                del self._inflight[key]
+
+        stream = self.create(on_close=release)
+        self._inflight[key] = stream
+        return stream, True
+
+    def get(self, stream_id):
+        return self._streams.get(stream_id)
+
+    def _evict(self):
+        for stream_id, stream in self._streams.items():
+            if stream.done:
+                del self._streams[stream_id]
+                return
+        self._streams.popitem(last=False)
+
+
+replay_buffer = ReplayBuffer()
+
+
+async def resume_stream(websocket, message_data):
+    """
+    Handles a resume message by replaying the missed chunks of a buffered
+    stream and then following it live.
+
+    Args:
+        websocket: The WebSocket connection object.
+        message_data (dict): The parsed resume message from the client.
+    """
+    stream = replay_buffer.get(message_data.get('streamId'))
+    if stream is None:
+        await websocket.send(json.dumps({
+            "role": "error",
+            "response": "Stream is no longer available",
+            "isDone": True,
+            "timestamp": None,
+            "streamId": message_data.get('streamId'),
+            "seq": None
+        }))
+        return
+    last_seq = message_data.get('lastSeq')
+    if not isinstance(last_seq, int):
+        last_seq = -1
+    print(f"Resuming stream {stream.stream_id} after seq {last_seq}", flush=True)
+    await stream.send_to(websocket, last_seq)
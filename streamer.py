@@ -2,8 +2,10 @@ import asyncio
 import websockets
 from google import genai
 import os
-import json
+from loop_monitor import start_loop_monitor
+from connections import SERVE_OPTIONS, ConnectionLimiter, receive_message
 from race_chat_handlers_less_data import handle_race_client
+from stream_replay import replay_buffer, resume_stream
 
 # Configure the Google Gemini API key
 client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
@@ -16,7 +18,7 @@ MODEL_MAPPINGS = {
 
 # Message format from user
 # MessageFromUser {
-#   role: 'user' | 'ping';
+#   role: 'user' | 'ping' | 'resume';   // 'ping' is no longer needed, the server sends protocol pings
 #   prompt: string;
 #   timestamp: number;
 #}
@@ -26,9 +28,12 @@ MODEL_MAPPINGS = {
 #   response: string; 
 #   isDone: boolean; 
 #   timestamp: Date; 
+#   streamId: string;
+#   seq: number;
 # }
+# See stream_replay.py for the resume message
 
-async def stream_response(prompt, queue, model_name='gemini-2.0-flash'):
+async def stream_response(prompt, stream, model_name='gemini-2.0-flash'):
     try:
         print(f"Processing prompt: {prompt}", flush=True)
         async for chunk in await client.aio.models.generate_content_stream(
@@ -41,14 +46,13 @@ async def stream_response(prompt, queue, model_name='gemini-2.0-flash'):
                 "isDone": False,
                 "timestamp": None
             }
-            await queue.put(json.dumps(message))
-        await queue.put(json.dumps({
+            await stream.put(message)
+        await stream.put({
             "role": "assistant",
             "response": "done message",
             "isDone": True,
             "timestamp": None
-        }))
-        await queue.put(None)
+        })
         print("Stream completed", flush=True)
     except Exception as e:
         error_message = {
@@ -57,7 +61,9 @@ async def stream_response(prompt, queue, model_name='gemini-2.0-flash'):
             "isDone": True,
             "timestamp": None
         }
-        await queue.put(json.dumps(error_message))
+        await stream.put(error_message)
+    finally:
+        await stream.close()
 
 async def handle_client(websocket):
     client_id = id(websocket)  # Get a unique ID for the client
@@ -65,13 +71,17 @@ async def handle_client(websocket):
     
     try:
         while True:
-            raw_message = await websocket.recv()
             try:
-                message_data = json.loads(raw_message)
-                
-                # Check message role
-                if message_data.get('role') == 'ping':
-                    print("Received ping from client - continuing", flush=True)
+                message_data = await receive_message(websocket)
+            except ValueError as e:
+                print(f"Invalid message received from client {client_id}: {str(e)}", flush=True)
+                continue
+            if message_data is None:
+                print(f"Closed idle client {client_id}", flush=True)
+                break
+            try:
+                if message_data.get('role') == 'resume':
+                    await resume_stream(websocket, message_data)
                     continue
                 
                 prompt = message_data.get('prompt')
@@ -81,19 +91,11 @@ async def handle_client(websocket):
                 print(f"Invalid message received from client {client_id}: {str(e)}", flush=True)
                 continue
 
-            queue = asyncio.Queue()
+            stream = replay_buffer.create()
             gemini_model_name = MODEL_MAPPINGS.get(model_name, 'gemini-2.0-flash')
-            asyncio.create_task(stream_response(prompt, queue, gemini_model_name))
-            
-            while True:
-                chunk = await queue.get()
-                if chunk is None:
-                    break
-                print(f"Sending chunk content: {json.loads(chunk).get('response')}", flush=True)  # chunk is already JSON string
-                await websocket.send(chunk)
+            stream.task = asyncio.create_task(stream_response(prompt, stream, gemini_model_name))
+            await stream.send_to(websocket)
     
-    except json.JSONDecodeError as e:
-        print(f"Invalid JSON received from client {client_id}: {str(e)}", flush=True)
     except websockets.exceptions.ConnectionClosedOK:
         print(f"Client {client_id} disconnected normally (code 1000)", flush=True)
     except websockets.exceptions.ConnectionClosedError as e:
@@ -104,12 +106,17 @@ async def handle_client(websocket):
 
 async def main():
     try:
+        # Kept for the lifetime of the server; its stalls are logged as they happen
+        stall_monitor = start_loop_monitor()
+
         routes = {
             "/chat": handle_client,
             "/race-chat": handle_race_client,
             "/": handle_client
         }
 
+        limiter = ConnectionLimiter()
+
         async def route_handler(websocket):
             path = websocket.request.path
             if path in routes:
@@ -117,7 +124,11 @@ async def main():
             else:
                 await websocket.close(4004, f"Path {path} not found")
 
-        server = await websockets.serve(route_handler, "localhost", 8765)
+        server = await websockets.serve(
+            route_handler, "localhost", 8765,
+            process_request=limiter.process_request,
+            **SERVE_OPTIONS
+        )
         print("WebSocket server started on ws://localhost:8765", flush=True)
         print("Available endpoints: /, /chat, and /race-chat", flush=True)
         await server.wait_closed()
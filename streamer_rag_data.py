@@ -3,7 +3,8 @@ import websockets
 from google import genai
 import os
 import json
-from embedding.v2_local.race_chat_handlers_with_embedding_v2 import handle_race_client
+from loop_monitor import start_loop_monitor
+from embedding.v2_local.race_chat_handlers_with_embedding_v2 import handle_race_client, index_store
 
 # TODO: Update input andoutput formats to match the new objects
 
@@ -55,7 +56,8 @@ async def handle_client(websocket):
                 continue
 
             queue = asyncio.Queue()
-            await asyncio.run(stream_response(content, queue, loop))
+            # Held so the task can't be garbage collected while it streams
+            response_task = asyncio.create_task(stream_response(content, queue, loop))
             
             while True:
                 chunk = await queue.get()
@@ -82,6 +84,11 @@ async def handle_client(websocket):
 
 async def main():
     try:
+        stall_monitor = start_loop_monitor()
+        # Background tasks only keep running while something references them,
+        # so these locals live for as long as the server does
+        index_watcher_task = asyncio.create_task(index_store.watch())
+
         routes = {
             "/chat": handle_client,
             "/race-chat-v2": handle_race_client,
@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import websockets
+
+# Measures what idle connections cost the route_handler server in streamer.py.
+# Starts the server, records its RSS and CPU time, opens N connections that
+# stay idle, then reports RSS and CPU per 10k idle connections. The server
+# runs with the event loop stall monitor on, and the run fails if it recorded
+# any stalls.
+#
+# Usage (from the repo root, Linux only):
+#   python test/bench-idle-connections.py --connections 10000 --window 60
+#   python test/bench-idle-connections.py --app-pings 30   # clients that still send role: 'ping'
+#
+# To compare against an older revision, check it out in a worktree and point
+# --server-dir at it, e.g.
+#   git worktree add /tmp/before <commit>
+#   python test/bench-idle-connections.py --server-dir /tmp/before
+
+URI = "ws://localhost:8765/race-chat"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+STALL_PATTERN = re.compile(r"^Event loop stalled for (\d+)ms in:$")
+
+
+def read_rss_bytes(pid):
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def read_cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime are fields 14 and 15, counted from after the process name
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def read_stalls(log):
+    """
+    Collects the stalls the server's loop monitor logged.
+
+    Returns:
+        list: (lag in ms, stack sample) for each stall.
+    """
+    log.seek(0)
+    stalls = []
+    for line in log.read().splitlines():
+        match = STALL_PATTERN.match(line)
+        if match:
+            stalls.append([int(match.group(1)), []])
+        elif stalls and line.startswith("  "):
+            stalls[-1][1].append(line)
+    return [(lag, "\n".join(stack)) for lag, stack in stalls]
+
+
+async def wait_for_server(timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with websockets.connect(URI, ping_interval=None):
+                return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+async def hold_connection(ready, stop, app_ping_interval, failures):
+    connected = False
+    try:
+        async with websockets.connect(URI, ping_interval=None, open_timeout=60) as websocket:
+            connected = True
+            ready.release()
+            while not stop.is_set():
+                if app_ping_interval:
+                    await asyncio.sleep(app_ping_interval)
+                    await websocket.send('{"role": "ping", "timestamp": 0}')
+                else:
+                    await stop.wait()
+    except Exception as e:
+        if not connected:
+            failures.append(e)
+    finally:
+        # Failed connects must release too, or run() waits for them forever
+        if not connected:
+            ready.release()
+
+
+async def run(args, log):
+    env = dict(os.environ)
+    env.setdefault("GEMINI_API_KEY", "benchmark")
+    env["LOOP_STALL_THRESHOLD_MS"] = str(args.stall_threshold_ms)
+    server = subprocess.Popen(
+        [sys.executable, "streamer.py"], cwd=args.server_dir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    try:
+        await wait_for_server()
+        await asyncio.sleep(1)
+        base_rss = read_rss_bytes(server.pid)
+
+        ready = asyncio.Semaphore(0)
+        stop = asyncio.Event()
+        failures = []
+        clients = []
+        for i in range(args.connections):
+            clients.append(asyncio.create_task(hold_connection(ready, stop, args.app_pings, failures)))
+            # Open in batches so the handshakes don't all time out together
+            if i % 500 == 499:
+                await asyncio.sleep(0.5)
+        for _ in range(args.connections):
+            await ready.acquire()
+        opened = args.connections - len(failures)
+        print(f"Opened {opened} of {args.connections} connections", flush=True)
+        if failures:
+            print(f"{len(failures)} connections failed, first error: {failures[0]!r}", flush=True)
+        if not opened:
+            raise RuntimeError("No connections could be opened")
+
+        await asyncio.sleep(2)
+        rss = read_rss_bytes(server.pid)
+        cpu_start = read_cpu_seconds(server.pid)
+        await asyncio.sleep(args.window)
+        cpu_used = read_cpu_seconds(server.pid) - cpu_start
+
+        scale = 10000 / opened
+        print(f"Server RSS at start:            {base_rss / 2**20:8.1f} MB")
+        print(f"Server RSS with connections:    {rss / 2**20:8.1f} MB")
+        print(f"RSS per 10k idle connections:   {(rss - base_rss) * scale / 2**20:8.1f} MB")
+        print(f"CPU per 10k idle connections:   {cpu_used * scale / args.window * 100:8.2f}% of a core "
+              f"(over {args.window:.0f}s)")
+
+        stop.set()
+        for client in clients:
+            client.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark idle websocket connections on streamer.py")
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--window", type=float, default=60, help="seconds to measure CPU over")
+    parser.add_argument("--app-pings", type=float, default=0, help="send role: 'ping' messages every N seconds")
+    parser.add_argument("--server-dir", default=".", help="checkout to run streamer.py from")
+    parser.add_argument("--stall-threshold-ms", type=float, default=100, help="event loop stall threshold for the server")
+    args = parser.parse_args()
+
+    # Each connection needs a file descriptor on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.connections * 2 + 100)), hard))
+    with tempfile.TemporaryFile("w+") as log:
+        asyncio.run(run(args, log))
+        stalls = read_stalls(log)
+
+    if stalls:
+        print(f"Event loop stalled {len(stalls)} times (worst {max(lag for lag, _ in stalls)}ms). "
+              f"First stall:\n{stalls[0][1]}")
+        sys.exit(1)
+    print(f"No event loop stalls over {args.stall_threshold_ms:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()